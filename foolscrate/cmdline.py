@@ -15,16 +15,16 @@ def cmdline():
 
 @cmdline.command()
 @click.argument("directory")
-@click.argument("remote_url")
-def create(directory, remote_url):
-    foolscrate.Repository.create_new(directory, remote_url, config_broker)
+@click.argument("remote_urls", nargs=-1, required=True)
+def create(directory, remote_urls):
+    foolscrate.Repository.create_new(directory, remote_urls, config_broker)
 
 
 @cmdline.command()
 @click.argument("directory")
-@click.argument("remote_url")
-def connect(directory, remote_url):
-    foolscrate.Repository.connect_existing(directory, remote_url, config_broker)
+@click.argument("remote_urls", nargs=-1, required=True)
+def connect(directory, remote_urls):
+    foolscrate.Repository.connect_existing(directory, remote_urls, config_broker)
 
 
 @cmdline.command()
@@ -33,6 +33,13 @@ def sync(directory):
     foolscrate.Repository(directory, config_broker).sync()
 
 
+@cmdline.command()
+@click.argument("remote_url")
+@click.argument("directory", default=".")
+def add_mirror(remote_url, directory):
+    foolscrate.Repository(directory, config_broker).add_mirror(remote_url)
+
+
 @cmdline.command()
 @click.argument("directory", default=".")
 def track(directory):
@@ -3,16 +3,18 @@ import logging
 import os
 import string
 import sys
-from time import sleep
+from time import sleep, time
 from shlex import quote as shell_quote
 from socket import gethostname
 from subprocess import check_output, CalledProcessError, Popen, PIPE
 from random import shuffle, uniform
 from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from configobj import ConfigObj
 from filelock import FileLock, Timeout
-from foolscrate.git import Git
+from foolscrate.git import Git, GitError, GitCommandError
 from os import access, R_OK, W_OK, X_OK
 from os.path import expanduser, join, abspath, exists, dirname
 from random import choice
@@ -27,6 +29,9 @@ class SyncError(Exception):
     def __init__(self, directory):
         super().__init__("Could not sync '{}'".format(directory))
 
+# result of probing a mirror: how long it took to answer, and where its master points (None if it has none yet)
+MirrorProbe = namedtuple("MirrorProbe", ["remote", "latency", "tip"])
+
 class Crontab(object):
     _crontab_command = "crontab"
 
@@ -58,14 +63,23 @@ class Repository(object):
 
     _logger = logging.getLogger("Repository")
 
+    # the first remote of a crate is always named like this, additional mirrors get a numbered name.
+    REMOTE_NAME = 'foolscrate'
+    MIRROR_REMOTE_PREFIX = 'foolscrate-mirror-'
+    _MIRROR_REMOTE_PATTERN = re_compile("^{}([0-9]+)$".format(MIRROR_REMOTE_PREFIX))
+    # git push reports these for a mirror holding commits we haven't merged yet; those strings are not translated.
+    _NON_FAST_FORWARD_PATTERN = re_compile(r"\[rejected\].*\((non-fast-forward|fetch first)\)")
+
     _SLEEP_BETWEEN_MERGE_ATTEMPTS_SECONDS = 1
+    _MIRROR_PROBE_TIMEOUT_SECONDS = 30
 
 
     @classmethod
-    def create_new(cls, local_directory, remote_url, config_broker):
+    def create_new(cls, local_directory, remote_urls, config_broker):
+        remote_urls = cls._as_url_list(remote_urls)
         cls._logger.info(
-            "Will create new foolscrate-enabled repository in local directory. Remote %s should exist and be empty.",
-            remote_url)
+            "Will create new foolscrate-enabled repository in local directory. Remotes %s should exist and be empty.",
+            remote_urls)
 
         if exists(join(local_directory, ".git")):
             raise ValueError("Preexisting git repo found")
@@ -75,34 +89,51 @@ class Repository(object):
             f.write(cls.CONFLICT_STRING + "\n")
             f.write(cls.LOCKFILE_NAME+ "\n")
 
-        git.cmd("remote", "add", "foolscrate", remote_url)
+        cls._add_mirror_remotes(git, remote_urls)
         git.cmd("add", cls.GITIGNORE)
         git.cmd("commit", "-m", "enabling foolscrate")
 
-        return cls._configure_repository(git, local_directory, config_broker)
+        # every remote must take our master, otherwise it wasn't empty (or is unusable) to begin with.
+        return cls._configure_repository(git, local_directory, config_broker, require_all_mirrors=True)
 
     @classmethod
-    def _configure_repository(cls, git, local_directory, config_broker):
+    def _configure_repository(cls, git, local_directory, config_broker, require_all_mirrors=False):
         client_id = cls._configure_client_id(git)
         cls._align_client_ref_to_master(git, client_id)
-        git.cmd("push", "-u", "foolscrate", "master", client_id)
+        mirrors = cls._mirror_remotes(git)
+        failures = cls._push_to_mirrors(git, mirrors, ["master", client_id])
+        if failures and (require_all_mirrors or len(failures) == len(mirrors)):
+            raise next(failures[remote] for remote in mirrors if remote in failures)
+        for remote, e in failures.items():
+            cls._logger.warning("Could not push to mirror %s, it'll be updated on next sync:\n%s\n%s\n",
+                                remote, e.stdout, e.stderr)
+        if cls.REMOTE_NAME not in failures:
+            git.cmd("branch", "--set-upstream-to", "{}/master".format(cls.REMOTE_NAME), "master")
         repo = cls(local_directory, config_broker=config_broker)
         repo.track()
         return repo
 
     @classmethod
-    def connect_existing(cls, local_directory, remote_url, config_broker):
+    def connect_existing(cls, local_directory, remote_urls, config_broker):
+        remote_urls = cls._as_url_list(remote_urls)
         cls._logger.info(
             "Will create new git repo in local directory and connect to remote existing foolscrate repository %s",
-            remote_url)
+            remote_urls)
 
         if exists(join(local_directory, ".git")):
             raise ValueError("Preexisting git repo found")
 
         git = Git.init(local_directory)
-        git.cmd("remote", "add", "foolscrate", remote_url)
-        git.cmd("fetch", "--all")
-        git.cmd("checkout", "master")
+        cls._add_mirror_remotes(git, remote_urls)
+        fetched = cls._fetch_from_mirrors(git, cls._probe_mirrors(git, cls._mirror_remotes(git)))
+        if not fetched:
+            raise ValueError("No reachable foolscrate repository with a master branch in {}".format(remote_urls))
+        unrelated = [ref for ref in fetched[1:] if not cls._shares_history(git, fetched[0], ref)]
+        if unrelated:
+            raise ValueError("Mirrors {} have no history in common with {}; are they the same foolscrate repository?"
+                             .format(", ".join(unrelated), fetched[0]))
+        # mirrors we didn't pick, if lagging or diverged, get reconciled on first sync.
+        git.cmd("checkout", "-b", "master", cls._freshest(git, fetched))
 
         return cls._configure_repository(git, local_directory, config_broker)
 
@@ -137,30 +168,53 @@ class Repository(object):
             # begin
             for attempt in range(0, 5):
                 self._logger.debug("Merge attempt n. %s", attempt)
-                self._git.cmd("fetch", "--all")
+                mirrors = self._probe_mirrors(self._git, self._mirror_remotes(self._git))
+                if not mirrors:
+                    self._logger.error("No mirror is reachable, not syncing")
+                    raise SyncError(self.localdir)
+                fetched = self._fetch_from_mirrors(self._git, mirrors)
                 self._git.cmd("add", "-A")
-                any_change = self._git.cmd("diff", "--staged").strip()
-
-                if any_change != "":
+                if self._any_staged_change(self._git):
                     self._git.cmd("commit", "-m", "Automatic foolscrate commit")
 
                 try:
-                    self._git.cmd("merge", "--no-edit", "foolscrate/master")
+                    # merging only ever moves master forward; anything a mirror has that we don't gets in,
+                    # a mirror that is behind just gets fast-forwarded by our push.
+                    for ref in fetched:
+                        if self._contains(self._git, "master", ref):
+                            continue
+                        if not self._shares_history(self._git, "master", ref):
+                            self._logger.error("%s has no history in common with ours, not merging it", ref)
+                            continue
+                        self._git.cmd("merge", "--no-edit", ref)
                 except Exception as e:
-                    self._logger.exception("Error while merging, aborting merge")
-                    self._git.cmd("merge", "--abort")
+                    self._logger.exception("Error while merging")
+                    # git may refuse to merge before even starting, e.g. if untracked files would be overwritten
+                    if exists(join(self.localdir, ".git", "MERGE_HEAD")):
+                        self._logger.info("Aborting merge")
+                        self._git.cmd("merge", "--abort")
                     sleep(self._SLEEP_BETWEEN_MERGE_ATTEMPTS_SECONDS)
                     continue
 
                 self._align_client_ref_to_master(self._git, self.client_id)
 
-                try:
-                    self._git.cmd("push", "foolscrate", "master", self.client_id)
-                except CalledProcessError as e:
-                    self._logger.exception("Error while pushing:\n%s\n%s\n", e.stdout, e.stderr)
-                    sleep(self._SLEEP_BETWEEN_MERGE_ATTEMPTS_SECONDS)
-                    continue
-                break
+                remotes = [mirror.remote for mirror in mirrors]
+                failures = self._push_to_mirrors(self._git, remotes, ["master", self.client_id])
+                if len(failures) < len(remotes):
+                    # some mirror took our master; whatever happened to the others (stuck, read-only,
+                    # or ahead of us) gets reconciled on next sync.
+                    for remote, e in failures.items():
+                        self._logger.warning("Could not push to mirror %s, skipped:\n%s\n%s\n",
+                                             remote, e.stdout, e.stderr)
+                    break
+                non_fast_forward = [remote for remote, e in failures.items() if self._is_non_fast_forward(e)]
+                if not non_fast_forward:
+                    # no mirror is usable right now, but that's no conflict: don't retry, don't mark it as such.
+                    raise failures[remotes[0]]
+                for remote in non_fast_forward:
+                    e = failures[remote]
+                    self._logger.error("Push to %s rejected:\n%s\n%s\n", remote, e.stdout, e.stderr)
+                sleep(self._SLEEP_BETWEEN_MERGE_ATTEMPTS_SECONDS)
             else:
                 self._logger.error(
                     "Couldn't succeed at merging or pushing back our changes, probably we've got a conflict")
@@ -170,6 +224,142 @@ class Repository(object):
 
             self._logger.info("Sync succeeded")
 
+    def add_mirror(self, remote_url):
+        """Adds a further mirror to this crate; it's populated on next sync."""
+        self._add_mirror_remotes(self._git, [remote_url])
+
+    @classmethod
+    def _any_staged_change(cls, git):
+        try:
+            git.cmd("diff", "--staged", "--quiet")
+        except GitCommandError as e:
+            if e.returncode == 1:
+                return True
+            raise
+        return False
+
+    @classmethod
+    def _log_git_output(cls, lines):
+        for line in lines:
+            cls._logger.debug("git: %s", line.rstrip())
+
+    @classmethod
+    def _as_url_list(cls, remote_urls):
+        if isinstance(remote_urls, str):
+            remote_urls = [remote_urls]
+        remote_urls = list(remote_urls)
+        if not remote_urls:
+            raise ValueError("At least a remote url is required")
+        return remote_urls
+
+    @classmethod
+    def _mirror_remotes(cls, git):
+        remotes = git.cmd("remote").split()
+        mirrors = sorted((remote for remote in remotes if cls._mirror_index(remote) is not None),
+                         key=cls._mirror_index)
+        return ([cls.REMOTE_NAME] if cls.REMOTE_NAME in remotes else []) + mirrors
+
+    @classmethod
+    def _mirror_index(cls, remote):
+        match = cls._MIRROR_REMOTE_PATTERN.match(remote)
+        return int(match.group(1)) if match else None
+
+    @classmethod
+    def _add_mirror_remotes(cls, git, remote_urls):
+        remotes = cls._mirror_remotes(git)
+        for remote_url in remote_urls:
+            if not remotes:
+                name = cls.REMOTE_NAME
+            else:
+                # indexes may have gaps if some mirror was removed
+                last_index = max((index for index in map(cls._mirror_index, remotes) if index is not None),
+                                 default=0)
+                name = "{}{}".format(cls.MIRROR_REMOTE_PREFIX, last_index + 1)
+            git.cmd("remote", "add", name, remote_url)
+            remotes.append(name)
+
+    @classmethod
+    def _probe_mirrors(cls, git, remotes):
+        """Returns reachable mirrors, fastest first. Probes run in parallel."""
+        def probe(remote):
+            start = time()
+            try:
+                out = git.cmd("ls-remote", remote, "refs/heads/master", timeout=cls._MIRROR_PROBE_TIMEOUT_SECONDS)
+            except GitError as e:
+                cls._logger.warning("Mirror %s is unreachable: %s", remote, e)
+                return None
+            return MirrorProbe(remote, time() - start, out.split()[0] if out.strip() else None)
+
+        if not remotes:
+            return []
+        with ThreadPoolExecutor(max_workers=len(remotes)) as executor:
+            probes = [p for p in executor.map(probe, remotes) if p is not None]
+        return sorted(probes, key=lambda p: p.latency)
+
+    @classmethod
+    def _fetch_from_mirrors(cls, git, probes):
+        """Fetches from the fastest mirrors, skipping those whose tip is already known to us.
+
+        Returns the remote-tracking refs that were fetched."""
+        fetched = []
+        for probe in probes:
+            if probe.tip is None:
+                continue
+            if any(cls._contains(git, ref, probe.tip) for ref in ["master"] + fetched):
+                cls._logger.debug("Mirror %s has nothing new, not fetching", probe.remote)
+                continue
+            try:
+                cls._log_git_output(git.stream("fetch", probe.remote, merge_stderr=True))
+            except GitError as e:
+                cls._logger.warning("Could not fetch from mirror %s, skipped: %s", probe.remote, e)
+                continue
+            fetched.append("{}/master".format(probe.remote))
+        return fetched
+
+    @classmethod
+    def _push_to_mirrors(cls, git, remotes, refs):
+        """Pushes refs to all remotes in parallel; returns failed remotes along with their error."""
+        def push(remote):
+            try:
+                cls._log_git_output(git.stream("push", remote, *refs))
+            except GitError as e:
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(remotes)) as executor:
+            results = list(executor.map(push, remotes))
+        return {remote: e for remote, e in zip(remotes, results) if e is not None}
+
+    @classmethod
+    def _is_non_fast_forward(cls, e):
+        return isinstance(e, GitCommandError) and bool(cls._NON_FAST_FORWARD_PATTERN.search(e.stderr or ""))
+
+    @classmethod
+    def _freshest(cls, git, refs):
+        """Picks the ref that contains the others; refs are ordered by preference in case of divergence."""
+        freshest = refs[0]
+        for ref in refs[1:]:
+            if cls._contains(git, ref, freshest):
+                freshest = ref
+        return freshest
+
+    @classmethod
+    def _shares_history(cls, git, ref, other_ref):
+        try:
+            git.cmd("merge-base", ref, other_ref)
+        except GitCommandError:
+            return False
+        return True
+
+    @classmethod
+    def _contains(cls, git, ref, commit):
+        """Tells whether commit is reachable from ref; unknown commits or refs are not."""
+        try:
+            git.cmd("merge-base", "--is-ancestor", commit, ref)
+        except GitCommandError:
+            return False
+        return True
+
     def track(self):
         with self._config_broker.provide() as cfg:
             # configobj doesn't support sets natively, only lists.
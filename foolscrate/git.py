@@ -1,14 +1,57 @@
 # -*- coding: utf-8 -*-
-from subprocess import check_output, PIPE
+import os
+import signal
+from collections import deque
+from subprocess import check_output, Popen, PIPE, STDOUT, CalledProcessError, TimeoutExpired
+from tempfile import TemporaryFile
+from threading import Timer, Event, Lock
+from time import sleep, time
 
 from os.path import abspath, join
 
 
+class GitError(Exception):
+    pass
+
+
+class GitCommandError(GitError, CalledProcessError):
+    """A git command exited with a nonzero status. Only the tail of its output is retained."""
+
+
+class GitTimeoutError(GitError, TimeoutExpired):
+    """A git command didn't complete in time; its whole process group has been terminated."""
+
+
 class Git(object):
-    def __init__(self, root_repository_dir):
+    # network operations may legitimately take a while, but a stuck remote (e.g. an ssh
+    # connection that never answers) must not hang us forever. Local operations have no
+    # timeout by default: on a large worktree they're just slow, not stuck.
+    NETWORK_TIMEOUT_SECONDS = 300
+    LOCAL_TIMEOUT_SECONDS = None
+    NETWORK_COMMANDS = frozenset(["fetch", "push", "pull", "clone", "ls-remote"])
+
+    # git removes its lock files on SIGTERM, but not on SIGKILL; so we give it some time
+    # to clean up before resorting to the latter.
+    _KILL_GRACE_SECONDS = 5
+    _MAX_POLL_INTERVAL_SECONDS = 0.05
+
+    # every command runs in its own session, so that on timeout we can terminate it along with
+    # any helper it spawned. This detaches it from our terminal: git and ssh can't prompt for
+    # credentials, so we make them fail right away instead (use an ssh agent or a credential helper).
+    _SSH_BATCH_OPTION = "-o BatchMode=yes"
+
+    # how much output we keep around in order to report errors
+    _ERROR_OUTPUT_TAIL_LINES = 50
+    _ERROR_STDERR_TAIL_BYTES = 64 * 1024
+
+    def __init__(self, root_repository_dir, network_timeout=None, local_timeout=None):
         self._root_repository_dir = root_repository_dir
         self._git_command = self._generate_git_command(root_repository_dir)
+        self._network_timeout = self.NETWORK_TIMEOUT_SECONDS if network_timeout is None else network_timeout
+        self._local_timeout = self.LOCAL_TIMEOUT_SECONDS if local_timeout is None else local_timeout
+        self._env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
         self.cmd("status")
+        self._env = self._batch_environment()
 
     @classmethod
     def _generate_git_command(cls, local_directory):
@@ -16,8 +59,121 @@ class Git(object):
         gitdir = join(abs_local_directory, ".git")
         return ["git", "--work-tree={}".format(abs_local_directory), "--git-dir={}".format(gitdir)]
 
-    def cmd(self, *args):
-        return check_output(self._git_command + list(args), universal_newlines=True, stderr=PIPE)
+    def cmd(self, *args, timeout=None):
+        return "".join(self.stream(*args, timeout=timeout))
+
+    def stream(self, *args, timeout=None, merge_stderr=False):
+        """Runs a git command and yields its stdout line by line, as soon as it's available.
+
+        If timeout (seconds) is not given, it's chosen depending on whether the command talks
+        to a remote or not. On expiry the whole process group is terminated and GitTimeoutError is
+        raised; a nonzero exit status raises GitCommandError. Closing the generator before exhausting
+        it terminates the command as well. If merge_stderr is set, stderr (e.g. fetch/push progress)
+        is yielded along with stdout.
+        """
+        command = self._git_command + list(args)
+        if timeout is None:
+            timeout = self._timeout_for(args)
+
+        with TemporaryFile() as stderr_file:
+            process = Popen(command, stdout=PIPE, stderr=STDOUT if merge_stderr else stderr_file,
+                            universal_newlines=True, start_new_session=True, env=self._env)
+            # the process is only ever reaped while holding this lock, so that we never signal
+            # a process group whose leader is gone and whose pid may have been reused.
+            reap_lock = Lock()
+            expired = Event()
+            timers = []
+
+            def expire():
+                expired.set()
+                self._signal_process_group(process, reap_lock, signal.SIGTERM)
+                start_timer(self._KILL_GRACE_SECONDS, self._signal_process_group,
+                            process, reap_lock, signal.SIGKILL)
+
+            def start_timer(interval, function, *args):
+                timer = Timer(interval, function, args)
+                timer.daemon = True
+                timers.append(timer)
+                timer.start()
+
+            if timeout is not None:
+                start_timer(timeout, expire)
+            output_tail = deque(maxlen=self._ERROR_OUTPUT_TAIL_LINES)
+            try:
+                for line in process.stdout:
+                    output_tail.append(line)
+                    yield line
+                returncode = self._wait(process, reap_lock)
+            finally:
+                if process.returncode is None:
+                    # we were either closed early or something went wrong while yielding
+                    self._terminate(process, reap_lock)
+                for timer in list(timers):
+                    timer.cancel()
+                process.stdout.close()
+
+            stderr = None if merge_stderr else self._read_tail(stderr_file)
+
+        if returncode != 0 and expired.is_set():
+            raise GitTimeoutError(command, timeout, output="".join(output_tail), stderr=stderr)
+        if returncode != 0:
+            raise GitCommandError(returncode, command, output="".join(output_tail), stderr=stderr)
+
+    def _batch_environment(self):
+        env = dict(self._env)
+        if "GIT_SSH_COMMAND" in env or "GIT_SSH" in env:
+            # user's choice, we don't touch it
+            return env
+        try:
+            ssh_command = self.cmd("config", "--get", "core.sshCommand").strip()
+        except GitCommandError:
+            ssh_command = "ssh"
+        env["GIT_SSH_COMMAND"] = "{} {}".format(ssh_command, self._SSH_BATCH_OPTION)
+        return env
+
+    def _timeout_for(self, args):
+        if args and args[0] in self.NETWORK_COMMANDS:
+            return self._network_timeout
+        return self._local_timeout
+
+    @classmethod
+    def _signal_process_group(cls, process, reap_lock, signum):
+        # start_new_session=True makes the git process the leader of its own group, so this
+        # reaches any helper it spawned as well (ssh, remote helpers, hooks...)
+        with reap_lock:
+            if process.returncode is not None:
+                return
+            try:
+                os.killpg(process.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    @classmethod
+    def _wait(cls, process, reap_lock, timeout=None):
+        """Waits for process to exit, reaping it under reap_lock; returns None on timeout."""
+        interval = 0.001
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            with reap_lock:
+                if process.poll() is not None:
+                    return process.returncode
+            if deadline is not None and time() >= deadline:
+                return None
+            sleep(interval)
+            interval = min(interval * 2, cls._MAX_POLL_INTERVAL_SECONDS)
+
+    @classmethod
+    def _terminate(cls, process, reap_lock):
+        cls._signal_process_group(process, reap_lock, signal.SIGTERM)
+        if cls._wait(process, reap_lock, cls._KILL_GRACE_SECONDS) is None:
+            cls._signal_process_group(process, reap_lock, signal.SIGKILL)
+            cls._wait(process, reap_lock)
+
+    @classmethod
+    def _read_tail(cls, f):
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - cls._ERROR_STDERR_TAIL_BYTES))
+        return f.read().decode("utf-8", "replace")
 
     @classmethod
     def init(self, root_repository_dir):
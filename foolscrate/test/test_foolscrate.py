@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
+from unittest.mock import patch
 
 from shutil import rmtree
 
@@ -11,8 +12,9 @@ from tempfile import TemporaryDirectory, mkdtemp, NamedTemporaryFile, mktemp
 import os, sys
 from subprocess import check_call, check_output, DEVNULL, call, CalledProcessError
 
-from foolscrate.foolscrate import Repository,  SyncError, ConfigBroker, SyncAll
-from foolscrate.git import Git
+from foolscrate.foolscrate import Repository,  SyncError, ConfigBroker, SyncAll, MirrorProbe
+from foolscrate.git import Git, GitCommandError, GitTimeoutError
+from time import time
 import logging
 
 from os.path import exists
@@ -61,6 +63,16 @@ class TestRepository(TestCase):
                     self.assertTrue(second_repo.client_id in all_branches)
 
 
+def _write_script(path, script):
+    with open(path, mode="w", encoding="ascii") as f:
+        f.write("#!/bin/sh\n" + script + "\n")
+    os.chmod(path, 0o755)
+
+
+def _install_hook(bare_repo_dir, hook_name, script):
+    _write_script(join(bare_repo_dir, "hooks", hook_name), script)
+
+
 class TestSync(TestCase):
     def setUp(self):
         self._conftmp = TemporaryDirectory()
@@ -191,6 +203,21 @@ class TestSync(TestCase):
         self.second_repo.sync()
         self.second_repo.sync()
 
+    def test_hung_remote_aborts_sync_without_retrying_or_declaring_conflict(self):
+        _install_hook(self.remote_repo_dir, "pre-receive", "sleep 60")
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+
+        with patch.object(Git, "NETWORK_TIMEOUT_SECONDS", 2):
+            repo = Repository(self.first_client_dir, self.config_broker)
+            start = time()
+            with self.assertRaises(GitTimeoutError):
+                repo.sync()
+
+        # any retry would take at least another timeout plus the pause between attempts
+        self.assertLess(time() - start, 4)
+        self.assertFalse(exists(join(self.first_client_dir, CONFLICT_STRING)))
+
     def test_untracked_repository_doesnt_get_synced_by_sync_all_tracked(self):
         self.second_repo.untrack()
 
@@ -202,6 +229,292 @@ class TestSync(TestCase):
         self.assertFalse(exists(join(self.second_client_dir, "something")))
 
 
+def _bare_master(bare_repo_dir):
+    return check_output(["git", "--git-dir={}".format(bare_repo_dir), "rev-parse", "master"],
+                        universal_newlines=True).strip()
+
+
+def _bare_with_unrelated_commit():
+    bare_repo_dir = mkdtemp()
+    check_call(["git", "init", "-q", "--bare", bare_repo_dir])
+    with TemporaryDirectory() as work_dir:
+        check_call(["git", "init", "-q", work_dir])
+        with open(join(work_dir, "unrelated"), mode="w", encoding="ascii") as f:
+            f.write("unrelated")
+        git = ["git", "-C", work_dir]
+        check_call(git + ["add", "unrelated"])
+        check_call(git + ["commit", "-q", "-m", "unrelated"])
+        check_call(git + ["push", "-q", bare_repo_dir, "master"])
+    return bare_repo_dir
+
+
+class TestMirrors(TestCase):
+    def setUp(self):
+        self._conftmp = TemporaryDirectory()
+        self.config_broker = ConfigBroker(join(self._conftmp.name, ".foolscrate.conf"), join(self._conftmp.name, ".foolscrate.conf.lock"))
+
+        self.first_mirror_dir = mkdtemp()
+        self.second_mirror_dir = mkdtemp()
+        check_call(["git", "init", "--bare", self.first_mirror_dir])
+        check_call(["git", "init", "--bare", self.second_mirror_dir])
+        self.mirror_dirs = [self.first_mirror_dir, self.second_mirror_dir]
+
+        self.first_client_dir = mkdtemp()
+        self.second_client_dir = mkdtemp()
+
+        self.first_repo = Repository.create_new(self.first_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+
+    def tearDown(self):
+        for directory in self.mirror_dirs + [self.first_client_dir, self.second_client_dir]:
+            rmtree(directory, ignore_errors=True)
+        self._conftmp.cleanup()
+
+    def test_create_pushes_to_all_mirrors(self):
+        self.assertEqual(_bare_master(self.first_mirror_dir), _bare_master(self.second_mirror_dir))
+
+    def test_sync_replicates_to_all_mirrors(self):
+        second_repo = Repository.connect_existing(self.second_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+
+        self.first_repo.sync()
+        self.assertEqual(_bare_master(self.first_mirror_dir), _bare_master(self.second_mirror_dir))
+
+        second_repo.sync()
+        with open(join(self.second_client_dir, "something"), mode="r", encoding="ascii") as f:
+            self.assertEqual("asd", f.read())
+
+    def test_connect_checks_out_freshest_mirror(self):
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+        self.first_repo.sync()
+        stale = check_output(["git", "--git-dir={}".format(self.first_mirror_dir), "rev-parse", "master~1"],
+                             universal_newlines=True).strip()
+        check_call(["git", "--git-dir={}".format(self.first_mirror_dir), "update-ref", "refs/heads/master", stale])
+
+        Repository.connect_existing(self.second_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+
+        self.assertTrue(exists(join(self.second_client_dir, "something")))
+
+    def test_stale_mirror_is_caught_up_and_master_doesnt_regress(self):
+        second_repo = Repository.connect_existing(self.second_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+        self.first_repo.sync()
+        second_repo.sync()
+        fresh = _bare_master(self.second_mirror_dir)
+        check_call(["git", "--git-dir={}".format(self.second_mirror_dir), "update-ref", "refs/heads/master",
+                    fresh + "~1"])
+
+        second_repo.sync()
+
+        self.assertTrue(exists(join(self.second_client_dir, "something")))
+        self.assertEqual(fresh, _bare_master(self.second_mirror_dir))
+
+    def test_sync_succeeds_while_a_mirror_is_unreachable(self):
+        second_repo = Repository.connect_existing(self.second_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+        rmtree(self.second_mirror_dir)
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+
+        self.first_repo.sync()
+        second_repo.sync()
+
+        with open(join(self.second_client_dir, "something"), mode="r", encoding="ascii") as f:
+            self.assertEqual("asd", f.read())
+
+    def _commit_on_first_client(self):
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+        self.first_repo.sync()
+        return _bare_master(self.first_mirror_dir)
+
+    def _use_upload_pack(self, git, remote, script):
+        # lets a mirror misbehave when we read from it, while still accepting pushes
+        upload_pack = join(self._conftmp.name, "upload-pack-{}".format(remote))
+        _write_script(upload_pack, script)
+        git.cmd("config", "remote.{}.uploadpack".format(remote), upload_pack)
+
+    def test_sync_succeeds_while_a_mirror_refuses_pushes(self):
+        _install_hook(self.second_mirror_dir, "pre-receive", "exit 1")
+
+        fresh = self._commit_on_first_client()
+
+        self.assertFalse(exists(join(self.first_client_dir, CONFLICT_STRING)))
+        self.assertNotEqual(fresh, _bare_master(self.second_mirror_dir))
+
+    def test_sync_succeeds_while_a_mirror_hangs_on_push(self):
+        _install_hook(self.second_mirror_dir, "pre-receive", "sleep 60")
+        with open(join(self.first_client_dir, "something"), mode="w", encoding="ascii") as f:
+            f.write("asd")
+
+        with patch.object(Git, "NETWORK_TIMEOUT_SECONDS", 2):
+            Repository(self.first_client_dir, self.config_broker).sync()
+
+        self.assertNotEqual(_bare_master(self.first_mirror_dir), _bare_master(self.second_mirror_dir))
+
+    def test_probe_orders_mirrors_by_latency_and_drops_unreachable_ones(self):
+        git = Git(self.first_client_dir)
+        self._use_upload_pack(git, "foolscrate", 'sleep 1; exec git-upload-pack "$@"')
+        third_mirror_dir = join(self._conftmp.name, "nonexistent")
+        self.first_repo.add_mirror(third_mirror_dir)
+
+        probes = Repository._probe_mirrors(git, Repository._mirror_remotes(git))
+
+        self.assertEqual(["foolscrate-mirror-1", "foolscrate"], [probe.remote for probe in probes])
+        self.assertEqual([_bare_master(self.first_mirror_dir)] * 2, [probe.tip for probe in probes])
+
+    def test_fetch_skips_mirrors_with_nothing_new(self):
+        old = _bare_master(self.first_mirror_dir)
+        fresh = self._commit_on_first_client()
+        git = Git(self.first_client_dir)
+        check_call(["git", "--git-dir={}".format(join(self.first_client_dir, ".git")), "update-ref",
+                    "refs/heads/master", old])
+
+        fetched = Repository._fetch_from_mirrors(git, [
+            MirrorProbe("foolscrate", 0.1, old),
+            MirrorProbe("foolscrate-mirror-1", 0.2, fresh),
+            MirrorProbe("foolscrate", 0.3, fresh),
+            MirrorProbe("foolscrate-mirror-1", 0.4, None),
+        ])
+
+        self.assertEqual(["foolscrate-mirror-1/master"], fetched)
+
+    def test_fetch_falls_back_to_next_mirror_when_one_fails_or_hangs(self):
+        second_repo = Repository.connect_existing(self.second_client_dir, self.mirror_dirs, config_broker=self.config_broker)
+        fresh = self._commit_on_first_client()
+        third_mirror_dir = mkdtemp()
+        self.mirror_dirs.append(third_mirror_dir)
+        check_call(["git", "clone", "--bare", "-q", self.first_mirror_dir, third_mirror_dir])
+        second_repo.add_mirror(third_mirror_dir)
+        git = Git(self.second_client_dir, network_timeout=2)
+        self._use_upload_pack(git, "foolscrate", "exit 1")
+        self._use_upload_pack(git, "foolscrate-mirror-1", "sleep 60")
+
+        fetched = Repository._fetch_from_mirrors(git, [
+            MirrorProbe("foolscrate", 0.1, fresh),
+            MirrorProbe("foolscrate-mirror-1", 0.2, fresh),
+            MirrorProbe("foolscrate-mirror-2", 0.3, fresh),
+        ])
+
+        self.assertEqual(["foolscrate-mirror-2/master"], fetched)
+
+    def test_mirror_names_skip_gaps_and_ignore_foreign_remotes(self):
+        git = Git(self.first_client_dir)
+        git.cmd("remote", "add", "foolscrate-mirror-x", self.first_mirror_dir)
+        self.first_repo.add_mirror(self.first_mirror_dir)
+        git.cmd("remote", "remove", "foolscrate-mirror-1")
+
+        self.first_repo.add_mirror(self.second_mirror_dir)
+
+        self.assertEqual(["foolscrate", "foolscrate-mirror-2", "foolscrate-mirror-3"], Repository._mirror_remotes(git))
+
+    def test_create_fails_if_a_mirror_is_not_empty(self):
+        unrelated_dir = _bare_with_unrelated_commit()
+        self.mirror_dirs.append(unrelated_dir)
+        with TemporaryDirectory() as client_dir:
+            with self.assertRaises(GitCommandError):
+                Repository.create_new(client_dir, [self.first_mirror_dir, unrelated_dir],
+                                      config_broker=self.config_broker)
+
+    def test_connect_refuses_mirrors_without_common_history(self):
+        unrelated_dir = _bare_with_unrelated_commit()
+        self.mirror_dirs.append(unrelated_dir)
+        with self.assertRaises(ValueError) as ctx:
+            Repository.connect_existing(self.second_client_dir, [self.first_mirror_dir, unrelated_dir],
+                                        config_broker=self.config_broker)
+        self.assertIn("foolscrate", str(ctx.exception))
+
+    def test_sync_doesnt_merge_unrelated_mirror(self):
+        unrelated_dir = _bare_with_unrelated_commit()
+        self.mirror_dirs.append(unrelated_dir)
+        self.first_repo.add_mirror(unrelated_dir)
+
+        fresh = self._commit_on_first_client()
+
+        self.assertFalse(exists(join(self.first_client_dir, "unrelated")))
+        self.assertEqual(fresh, _bare_master(self.second_mirror_dir))
+
+    def test_merge_refused_by_git_is_a_failed_attempt(self):
+        unrelated_dir = _bare_with_unrelated_commit()
+        self.mirror_dirs.append(unrelated_dir)
+        self.first_repo.add_mirror(unrelated_dir)
+
+        # git refuses to even start merging unrelated histories, so there's nothing to abort.
+        with patch.object(Repository, "_shares_history", return_value=True), \
+                patch.object(Repository, "_SLEEP_BETWEEN_MERGE_ATTEMPTS_SECONDS", 0):
+            with self.assertRaises(SyncError):
+                self.first_repo.sync()
+
+        self.assertTrue(exists(join(self.first_client_dir, CONFLICT_STRING)))
+
+    def test_added_mirror_is_populated_on_sync(self):
+        third_mirror_dir = mkdtemp()
+        self.mirror_dirs.append(third_mirror_dir)
+        check_call(["git", "init", "--bare", third_mirror_dir])
+
+        self.first_repo.add_mirror(third_mirror_dir)
+        self.first_repo.sync()
+
+        self.assertEqual(_bare_master(self.first_mirror_dir), _bare_master(third_mirror_dir))
+
+
+class TestGit(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.git = Git.init(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_stream_yields_output_line_by_line(self):
+        self.git.cmd("config", "--local", "foolscrate.first", "1")
+        self.git.cmd("config", "--local", "foolscrate.second", "2")
+        lines = list(self.git.stream("config", "--local", "--get-regexp", "foolscrate"))
+        self.assertEqual(["foolscrate.first 1\n", "foolscrate.second 2\n"], lines)
+
+    def test_failing_command_raises_typed_error(self):
+        with self.assertRaises(GitCommandError) as ctx:
+            self.git.cmd("rev-parse", "--verify", "nonexistent-branch")
+        self.assertIsInstance(ctx.exception, CalledProcessError)
+        self.assertNotEqual(0, ctx.exception.returncode)
+
+    def test_hung_command_is_killed_on_timeout(self):
+        # the alias runs through a shell, so sleep is a grandchild of git: it must be killed as well,
+        # otherwise it would keep stdout open and we'd wait for it.
+        start = time()
+        with self.assertRaises(GitTimeoutError):
+            self.git.cmd("-c", "alias.hang=!sleep 30", "hang", timeout=1)
+        self.assertLess(time() - start, 10)
+
+    def test_timed_out_command_gets_a_chance_to_clean_up(self):
+        marker = join(self._tmp.name, "terminated")
+        alias = "alias.hang=!trap 'touch {}; exit 1' TERM; sleep 30 & wait".format(marker)
+        with self.assertRaises(GitTimeoutError):
+            self.git.cmd("-c", alias, "hang", timeout=1)
+        self.assertTrue(exists(marker))
+
+    def test_explicit_zero_timeout_is_not_replaced_by_default(self):
+        git = Git(self._tmp.name, network_timeout=0)
+        self.assertEqual(0, git._timeout_for(("fetch", "--all")))
+
+    def test_git_and_ssh_never_prompt(self):
+        self.git.cmd("config", "--local", "core.sshCommand", "ssh -i somekey")
+        with patch.dict(os.environ):
+            os.environ.pop("GIT_SSH_COMMAND", None)
+            os.environ.pop("GIT_SSH", None)
+            git = Git(self._tmp.name)
+        env = git.cmd("-c", 'alias.env=!echo "$GIT_TERMINAL_PROMPT;$GIT_SSH_COMMAND"', "env")
+        self.assertEqual("0;ssh -i somekey -o BatchMode=yes\n", env)
+
+    def test_closing_stream_early_kills_command(self):
+        start = time()
+        stream = self.git.stream("-c", "alias.chatty=!echo started; sleep 30", "chatty")
+        self.assertEqual("started\n", next(stream))
+        stream.close()
+        self.assertLess(time() - start, 10)
+
+
 class SpyCrontab(object):
     def __init__(self):
         self.arguments = []